@@ -108,19 +108,57 @@ Liabilities:Loan              : -9875.0 USD
 """
 
 import argparse
+import array
+import bisect
+import bz2
 import collections
+import concurrent.futures
 import copy
+import csv
 import datetime
 import decimal
+import gzip
+import heapq
 import html
+import http.server
+import io
+import json
+import lzma
+import mmap
+import multiprocessing
 import os
+import pickle
+import re
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+import zipfile
 
 R = decimal.Decimal
 ZERO = R("0.0")
 BEGIN_TIME = datetime.date(2000, 1, 1)
 END_TIME = datetime.date(2999, 12, 31)
 
-__all__ = ("Wallet", "Amount", "Transaction", "Check", "Posting", "Pacioli")
+__all__ = (
+    "Wallet",
+    "Amount",
+    "Transaction",
+    "Check",
+    "Posting",
+    "Pacioli",
+    "Prices",
+    "HtmlSink",
+    "LatexSink",
+    "LedgerSink",
+    "JsonSink",
+    "CubeSink",
+    "Cube",
+    "SeriesSink",
+    "TimeSeries",
+)
 
 
 def err(msg, *args):
@@ -184,6 +222,146 @@ class Account:
         return str(self.wallet)
 
 
+class Prices:
+    """
+    historical prices, one sorted time series per (asset, currency) pair
+    rate(asset, currency, date) returns the last price on or before date,
+    using the inverse pair or one intermediate asset if needed
+    derived rates are cached until a new price is added
+    """
+
+    def __init__(self):
+        self.series = dict()
+        self.pairs = collections.defaultdict(set)
+        self.cache = dict()
+
+    def add(self, date, asset, value, currency):
+        dates, values = self.series.setdefault((asset, currency), ([], []))
+        i = bisect.bisect_left(dates, date)
+        if i < len(dates) and dates[i] == date:
+            values[i] = R(value)
+        else:
+            dates.insert(i, date)
+            values.insert(i, R(value))
+        self.pairs[asset].add(currency)
+        self.pairs[currency].add(asset)
+        self.cache.clear()
+
+    def __iter__(self):
+        for (asset, currency), (dates, values) in self.series.items():
+            for date, value in zip(dates, values):
+                yield date, asset, value, currency
+
+    def __len__(self):
+        return sum(len(dates) for dates, _ in self.series.values())
+
+    def direct(self, asset, currency, date):
+        if (asset, currency) in self.series:
+            dates, values = self.series[asset, currency]
+            i = bisect.bisect_right(dates, date)
+            if i:
+                return values[i - 1]
+        if (currency, asset) in self.series:
+            dates, values = self.series[currency, asset]
+            i = bisect.bisect_right(dates, date)
+            if i and values[i - 1]:
+                return 1 / values[i - 1]
+        return None
+
+    def rate(self, asset, currency, date):
+        if asset == currency:
+            return R(1)
+        key = (asset, currency, date)
+        if not key in self.cache:
+            rate = self.direct(asset, currency, date)
+            if rate is None:
+                for other in sorted(self.pairs[asset] & self.pairs[currency]):
+                    rate1 = self.direct(asset, other, date)
+                    rate2 = self.direct(other, currency, date)
+                    if rate1 is not None and rate2 is not None:
+                        rate = rate1 * rate2
+                        break
+            self.cache[key] = rate
+        return self.cache[key]
+
+
+class TimeSeries:
+    """
+    the balance of every account and asset after each day with changes,
+    recorded by Pacioli.run when p.series is a TimeSeries
+    days are stored as date ordinals and balances as floats in arrays
+    """
+
+    def __init__(self):
+        self.points = dict()
+        self.balances = dict()
+
+    def reset(self, accounts):
+        self.points = dict()
+        self.balances = dict()
+        for name, account in accounts.items():
+            for asset, value in account.wallet:
+                self.balances[name, asset] = value
+
+    def record(self, date, changes):
+        day = date.toordinal()
+        for name, value, asset in changes:
+            for sub in tree_traverse(name):
+                key = (sub, asset)
+                balance = self.balances[key] = self.balances.get(key, ZERO) + value
+                if not key in self.points:
+                    self.points[key] = (array.array("l"), array.array("d"))
+                days, values = self.points[key]
+                if days and days[-1] == day:
+                    values[-1] = float(balance)
+                else:
+                    days.append(day)
+                    values.append(float(balance))
+
+    def __call__(self, name, asset):
+        """returns the list of (date, balance) of an account and asset"""
+        days, values = self.points.get((name, asset), ((), ()))
+        return [(datetime.date.fromordinal(d), v) for d, v in zip(days, values)]
+
+    def downsample(self, name, asset, period="%Y-%m"):
+        """
+        returns a list of (period, last, min, max), one per period with changes
+        min and max include the balance carried from the previous period
+        """
+        buckets = []
+        previous = None
+        for date, value in self(name, asset):
+            key = date.strftime(period)
+            if buckets and buckets[-1][0] == key:
+                low, high = buckets[-1][2:]
+                buckets[-1] = (key, value, min(low, value), max(high, value))
+            else:
+                low = value if previous is None else min(previous, value)
+                high = value if previous is None else max(previous, value)
+                buckets.append((key, value, low, high))
+            previous = value
+        return buckets
+
+    def dump(self, filename, period=None):
+        """
+        writes {account: {asset: series}} in JSON where series is
+        {"day": [...], "balance": [...]} with days since 1970-01-01 or,
+        if period is given, {"period": [...], "last": [...], "min": [...], "max": [...]}
+        """
+        epoch = datetime.date(1970, 1, 1).toordinal()
+        data = dict()
+        for name, asset in sorted(self.points):
+            if period:
+                columns = list(zip(*self.downsample(name, asset, period)))
+                item = dict(zip(("period", "last", "min", "max"), map(list, columns)))
+            else:
+                days, values = self.points[name, asset]
+                item = dict(day=[d - epoch for d in days], balance=list(values))
+            data.setdefault(name, dict())[asset] = item
+        with open(filename, "w") as stream:
+            json.dump(data, stream, separators=(",", ":"))
+
+
 class Posting:
     __slots__ = ("name", "amount", "at", "comment", "book")
 
@@ -202,7 +380,7 @@ class Transaction:
         self.date = parse_date(date) if isinstance(date, str) else date
         self.info = info
         self.postings = postings or []
-        self.tags = tags or set()
+        self.tags = frozenset(tags or ())
         self.id = id
         self.pending = pending
 
@@ -226,7 +404,6 @@ class Transaction:
                 elif posting.at:
                     atvalue, atasset = posting.at.value, posting.at.asset
                     if other_value > 0:
-                        print(other_asset, other_value, atvalue, atasset)
                         p.fifos[other_asset].append((other_value, atvalue, atasset))
                     elif other_value < 0:
                         amount, profit, fifo = -other_value, 0.0, p.fifos[other_asset]
@@ -244,7 +421,6 @@ class Transaction:
                     value, asset = other_value * atvalue, atasset
                 else:
                     value, asset = other_value, other_asset
-                print(value, asset)
                 wallet_balance.add(Amount(-value, asset))
                 p.tree_add(name, other_value, other_asset)
             elif not pending_balance:
@@ -303,6 +479,56 @@ def parse_date(date):
         return None
 
 
+COMPRESSORS = {".gz": gzip.open, ".xz": lzma.open, ".bz2": bz2.open}
+
+
+def open_ledger(filename, mode="r", newline=None):
+    """opens a plain or a .gz, .xz, .bz2 compressed ledger in text mode"""
+    compressor = COMPRESSORS.get(os.path.splitext(filename)[1].lower())
+    if compressor:
+        return compressor(filename, mode + "t", encoding="utf8", newline=newline)
+    return open(filename, mode, newline=newline)
+
+
+def check_indexable(filename):
+    """byte offsets cannot be used to seek into compressed ledgers"""
+    if os.path.splitext(filename)[1].lower() in COMPRESSORS:
+        err("Compressed ledgers cannot be indexed: %s", filename)
+
+
+def measure_memory(
+    filename, begin_date=None, end_date=None, interned=True, run_size=None
+):
+    """
+    loads filename under tracemalloc and returns the bytes held by the loaded
+    ledger and its number of postings (before run adds the elided ones);
+    with interned=False names and tag sets are not shared (the baseline)
+    """
+    p = Pacioli(run_size, intern=interned)
+    tracemalloc.start()
+    try:
+        p.load(filename, begin_date, end_date)
+        memory = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    postings = sum(len(x.postings) for x in p.entries() if isinstance(x, Transaction))
+    return memory, postings
+
+
+def entry_key(item):
+    return (item.date, item.id)
+
+
+def read_run(stream):
+    """yields the entries pickled in a sorted run file"""
+    stream.seek(0)
+    while True:
+        try:
+            yield pickle.load(stream)
+        except EOFError:
+            return
+
+
 def tree_traverse(name):
     items = name.split(":")
     for k in range(len(items), 0, -1):
@@ -310,8 +536,112 @@ def tree_traverse(name):
         yield sub
 
 
+OFX_TAG = re.compile(r"<(/?\w+)>([^<\r\n]*)")
+
+
+def statement_transaction(date, account, other, value, asset, payee):
+    """makes a transaction from a bank statement record, other is elided"""
+    info = " ".join(payee.replace(";", ",").split()) or "(no payee)"
+    amount = Amount(value.replace(",", "").strip(), asset.strip())
+    return Transaction(date, info, postings=[Posting(account, amount), Posting(other)])
+
+
+def statement_key(transaction, posting):
+    """the key used to detect duplicate statement records"""
+    date, info, amount = transaction.date, transaction.info, posting.amount
+    return (date, posting.name, amount.value, amount.asset, info)
+
+
+def read_csv(
+    stream,
+    account,
+    other,
+    asset="USD",
+    columns=("date", "amount", "payee"),
+    date_format="%Y-%m-%d",
+):
+    """yields one transaction per row of a csv bank statement with a header"""
+    date, amount, payee = columns
+    for row in csv.DictReader(stream):
+        yield statement_transaction(
+            datetime.datetime.strptime(row[date].strip(), date_format).date(),
+            account,
+            other,
+            row[amount],
+            asset,
+            row[payee] or "",
+        )
+
+
+def read_ofx(stream, account, other):
+    """yields one transaction per STMTTRN record of an OFX (SGML or XML) statement"""
+    asset, record = "USD", None
+    for line in stream:
+        for tag, value in OFX_TAG.findall(line):
+            tag = tag.upper()
+            if tag == "CURDEF":
+                asset = value.strip()
+            elif tag == "STMTTRN":
+                record = dict()
+            elif tag == "/STMTTRN" and record is not None:
+                for key in ("DTPOSTED", "TRNAMT"):
+                    if not key in record:
+                        err("OFX transaction without %s: %s", key, record)
+                date = datetime.datetime.strptime(record["DTPOSTED"][:8], "%Y%m%d")
+                yield statement_transaction(
+                    date.date(),
+                    account,
+                    other,
+                    record["TRNAMT"],
+                    asset,
+                    record.get("NAME") or record.get("MEMO") or "",
+                )
+                record = None
+            elif record is not None:
+                record[tag] = html.unescape(value.strip())
+
+
+def read_window(filename, header, offset):
+    """yields the lines of filename before byte header and from byte offset on"""
+    with open(filename, "rb") as stream:
+        position = 0
+        for line in stream:
+            if position >= header:
+                break
+            position += len(line)
+            yield line.decode("utf8")
+        stream.seek(offset)
+        for line in stream:
+            yield line.decode("utf8")
+
+
+def map_account(name, mapping):
+    """renames the longest prefix of name found in mapping"""
+    for sub in tree_traverse(name):
+        if sub in mapping:
+            return mapping[sub] + name[len(sub) :]
+    return name
+
+
+def own_balances(accounts):
+    """returns {name: {asset: value}} excluding the balances of sub-accounts"""
+    balances = dict()
+    for name, account in accounts.items():
+        balances[name] = Wallet()
+        balances[name].add(account.wallet)
+    for name, account in accounts.items():
+        if ":" in name:
+            balances[name.rsplit(":", 1)[0]].sub(account.wallet)
+    return dict(
+        (name, dict((asset, value) for asset, value in wallet if value))
+        for name, wallet in balances.items()
+    )
+
+
 class Pacioli:
 
+    CHECKPOINT_EVERY = 1000
+
     MODEL = dict(
         Assets="Assets",
         Liabilities="Liabilities",
@@ -320,30 +650,57 @@ class Pacioli:
         Expenses="Expenses",
     )
 
-    def __init__(self):
+    def __init__(self, run_size=None, intern=True):
+        """
+        if run_size is given, the ledger is kept on disk in sorted runs of
+        run_size entries (streaming mode) and merged by entries()
+        if intern, load shares one string per account and asset name and
+        one frozen set per combination of tags
+        """
         self.begin_date = BEGIN_TIME
         self.end_date = END_TIME
         self.ledger = []
+        self.run_size = run_size
+        self.runs = []
+        self.resolved = None
+        self.resolved_key = None
+        self.unresolved = []
+        self.journal = None
+        self.series = None
         self.accounts = dict()
         self.end_accounts = None
         self.begin_accounts = None
         self.diff_accounts = None
         self.leaf_accounts = []
         self.fifos = collections.defaultdict(list)
+        self.intern = sys.intern if intern else str
+        self.tagsets = dict() if intern else None
+        self.eliminations = Wallet()
+        self.opening = None
+        self.prices = Prices()
         for value in self.MODEL.values():
             self.open_account(value, BEGIN_TIME)
 
     def tree_add(self, name, value, asset):
+        if self.journal is not None:
+            self.journal.append((name, value, asset))
         amount = Amount(value, asset)
         for sub in tree_traverse(name):
-            assets = self.accounts[sub].assets
             self.accounts[sub].wallet.add(amount)
 
+    def intern_tags(self, tags):
+        """returns a frozen set of tags shared by all transactions with the same tags"""
+        tags = frozenset(tags)
+        if self.tagsets is None:
+            return tags
+        return self.tagsets.setdefault(tags, tags)
+
     def open_account(self, name, open_date, assets=None):
         if isinstance(assets, str):
             assets = [assets]
         for sub in tree_traverse(name):
             if not sub in self.accounts:
+                sub = self.intern(sub)
                 self.accounts[sub] = Account(sub, open_date, assets)
 
     def close_account(self, name, close_date):
@@ -353,11 +710,30 @@ class Pacioli:
             if key.startswith(prefix):
                 self.accounts[key].close_date = close_date
 
-    def load(self, filename):
-        stream = open(filename, "r") if isinstance(filename, str) else filename
+    def load(self, filename, begin_date=None, end_date=None):
+        """
+        if begin_date or end_date are given and filename has an up to date
+        index (see save), only the entries from the last checkpoint before
+        begin_date up to end_date are parsed and the checkpoint balances
+        become the opening balances
+        """
+        index = None
+        if (begin_date or end_date) and isinstance(filename, str):
+            index = self.load_index(filename)
+        if index:
+            checkpoints = index["checkpoints"]
+            checkpoint = checkpoints[0]
+            for item in checkpoints:
+                if begin_date and parse_date(item["date"]) <= begin_date:
+                    checkpoint = item
+            stream = read_window(filename, index["header"], checkpoint["offset"])
+            self.opening = checkpoint
+        else:
+            stream = open_ledger(filename) if isinstance(filename, str) else filename
         transaction = None
         pads = dict()
-        tags = set()
+        intern = self.intern
+        tags = self.intern_tags(())
         for lineno, line in enumerate(stream):
             line, comment = line.split(";", 1) if ";" in line else (line, "")
             if not line.strip():
@@ -366,14 +742,17 @@ class Pacioli:
                 break
             comment = comment.lstrip(";").strip()
             if line.startswith("pushtags"):
-                tags |= set(line.split()[1:])
+                tags = self.intern_tags(tags.union(line.split()[1:]))
             elif line.startswith("poptags"):
-                tags = tags - set(line.split()[1:])
+                tags = self.intern_tags(tags.difference(line.split()[1:]))
             elif not line.startswith(" "):
                 parts = line.strip().split()
                 date = parse_date(parts[0])
                 if not date:
                     continue
+                elif index and end_date and date > end_date:
+                    if not parts[1] in ("open", "close", "price"):
+                        break
                 if parts[1] == "open":
                     name = parts[2]
                     if not name.split(":")[0] in self.MODEL:
@@ -384,16 +763,16 @@ class Pacioli:
                     name = parts[2]
                     self.close_account(name, date)
                 elif parts[1] == "balance":
-                    name = parts[2]
+                    name = intern(parts[2])
                     value = parts[3]
-                    asset = parts[4]
+                    asset = intern(parts[4])
                     # print line
                     balance_with = (
                         pads[name][1]
                         if name in pads and pads[name][0] <= date
                         else None
                     )
-                    self.ledger.append(
+                    self.append(
                         Check(
                             date,
                             name,
@@ -402,6 +781,11 @@ class Pacioli:
                             id=lineno,
                         )
                     )
+                elif parts[1] == "price":
+                    "2008-01-02 price AAPL 185.40 USD"
+                    if len(parts) != 5:
+                        err("%i: Invalid line: %s", lineno, line)
+                    self.prices.add(date, parts[2], parts[3], parts[4])
                 elif parts[1] == "pad":
                     "@pad 2007-12-31 Assets:Current:Bank:Checking Equity:Opening-Balances"
                     name = parts[2]
@@ -422,16 +806,18 @@ class Pacioli:
                         pending=pending,
                         tags=tags,
                     )
-                    self.ledger.append(transaction)
+                    self.append(transaction)
                 else:
                     err("%i: Invalid line: 5s", lineno, line)
             elif line.startswith(" "):
                 if not transaction:
                     err("%i: Posting Outside Transaction: %s", lineno, line)
                 parts = line.strip().split()
-                name = parts[0]
+                name = intern(parts[0])
                 if name == "tags":
-                    transaction.tags |= set(parts[1:])
+                    transaction.tags = self.intern_tags(
+                        transaction.tags.union(parts[1:])
+                    )
                     continue
                 elif name not in self.accounts:
                     err("%i: Unkown accouunt: %s", lineno, name)
@@ -440,22 +826,22 @@ class Pacioli:
                 elif parts[1].lower() == "book":
                     posting = Posting(name=name, comment=comment, book=True)
                 elif len(parts) in (3, 6):
-                    amount = Amount(parts[1], parts[2])
+                    amount = Amount(parts[1], intern(parts[2]))
                     at = (
-                        Amount(parts[4], parts[5])
+                        Amount(parts[4], intern(parts[5]))
                         if len(parts) == 6 and parts[3] == "@"
                         else None
                     )
                     posting = Posting(
                         name=name, amount=amount, at=at, comment=comment, book=False
                     )
+                    if at:
+                        date = transaction.date
+                        self.prices.add(date, amount.asset, at.value, at.asset)
                 else:
                     err("%i: Invalid line: 5s", lineno, line)
                 transaction.postings.append(posting)
-        if transaction:
-            self.ledger.append(transaction)
-            transaction = None
-        self.ledger.sort(key=lambda obj: (obj.date, obj.id))
+        self.ledger.sort(key=entry_key)
         # find accounts which have no children
         keys = set(x.rsplit(":", 1)[0] + ":" for x in self.accounts)
         self.leaf_accounts = [x for x in self.accounts if not x + ":" in keys]
@@ -463,98 +849,500 @@ class Pacioli:
         if stream != filename:
             stream.close()
 
+    def append(self, item):
+        """adds an entry, in streaming mode full buffers are spilled as sorted runs"""
+        if self.run_size and len(self.ledger) >= self.run_size:
+            self.flush_run()
+        self.ledger.append(item)
+        self.resolved = None
+
+    def flush_run(self):
+        self.ledger.sort(key=entry_key)
+        stream = tempfile.TemporaryFile()
+        for item in self.ledger:
+            pickle.dump(item, stream, pickle.HIGHEST_PROTOCOL)
+        self.runs.append(stream)
+        self.ledger = []
+
+    def entries(self):
+        """iterates over the entries sorted by (date, id), merging the runs if any"""
+        if self.unresolved:
+            self.resolve()
+        if not self.runs:
+            return iter(self.ledger)
+        runs = [read_run(stream) for stream in self.runs]
+        return heapq.merge(*runs, self.ledger, key=entry_key)
+
+    def load_index(self, filename):
+        """returns the index of filename written by save, None if missing or stale"""
+        try:
+            with open(filename + ".idx") as stream:
+                index = json.load(stream)
+        except (OSError, ValueError):
+            return None
+        stat = os.stat(filename)
+        if index.get("size") != stat.st_size or index.get("mtime") != stat.st_mtime_ns:
+            return None
+        if not index.get("checkpoints"):
+            return None  # a ledger without entries
+        return index
+
+    def write_index(self, filename, header, offsets):
+        """
+        writes filename.idx, the byte offsets of the entries of filename
+        (header is the offset of the first entry, offsets a list of
+        (position in self.ledger, offset) of the first entry of each date)
+        with the balances and lots before every checkpoint.
+        The ledger is replayed to compute them and the current balances restored.
+        """
+        check_indexable(filename)
+        positions, previous = dict(), None
+        for position, offset in offsets:
+            if previous is None or position - previous >= self.CHECKPOINT_EVERY:
+                positions[position] = offset
+                previous = position
+        last = previous
+        wallets = dict((name, acc.wallet) for name, acc in self.accounts.items())
+        fifos = self.fifos
+        checkpoints = []
+        self.reset()
+        for position, item in enumerate(self.entries()):
+            if last is None or position > last:
+                break
+            if position in positions:
+                balances = own_balances(self.accounts)
+                checkpoints.append(
+                    dict(
+                        date=str(item.date),
+                        offset=positions[position],
+                        balances=dict(
+                            (name, dict((a, str(v)) for a, v in balance.items()))
+                            for name, balance in balances.items()
+                            if balance
+                        ),
+                        fifos=dict(
+                            (asset, [[str(q), str(v), a] for q, v, a in fifo])
+                            for asset, fifo in self.fifos.items()
+                            if fifo
+                        ),
+                    )
+                )
+            item.run(self)
+        for name, wallet in wallets.items():
+            self.accounts[name].wallet = wallet
+        self.fifos = fifos
+        stat = os.stat(filename)
+        index = dict(size=stat.st_size, mtime=stat.st_mtime_ns, header=header)
+        index["checkpoints"] = checkpoints
+        with open(filename + ".idx", "w") as stream:
+            json.dump(index, stream)
+
     def reset(self):
+        self.journal = None
         self.fifos = collections.defaultdict(list)
         for account in self.accounts.values():
             account.wallet = Wallet()
+        if self.opening:
+            for name, balance in self.opening["balances"].items():
+                for asset, value in balance.items():
+                    self.tree_add(name, R(value), asset)
+            for asset, fifo in self.opening["fifos"].items():
+                self.fifos[asset] = [(R(q), R(v), a) for q, v, a in fifo]
+
+    def snapshot(self):
+        """a copy of the accounts and their balances"""
+        accounts = dict()
+        for name, account in self.accounts.items():
+            accounts[name] = copy.copy(account)
+            accounts[name].wallet = Wallet()
+            accounts[name].wallet.assets = dict(account.wallet.assets)
+        return accounts
 
     def run(self):
+        """
+        the first run balances the entries (elided postings, capital gains,
+        pads) and stores the changes to the accounts made by each entry in
+        self.resolved; later runs, for example with other begin_date and
+        end_date, only add up those changes. load() and append() discard them,
+        as does a run after entries were added to or removed from self.ledger.
+        in streaming mode the entries are discarded once applied, the
+        resolved entries are stored in a single run for the reports
+        """
         self.reset()
-        for item in self.ledger:
-            if not self.begin_accounts and item.date >= self.begin_date:
-                self.begin_accounts = copy.deepcopy(self.accounts)
-            if not self.end_accounts and item.date > self.end_date:
-                self.end_accounts = copy.deepcopy(self.accounts)
-            if isinstance(item, Transaction):
-                for posting in item.postings:
-                    account = self.accounts[posting.name]
-                    if item.date < account.open_date or item.date > account.close_date:
-                        err(f"Error: on {item.date} account {posting.name} is closed")
-            item.run(self)
+        self.begin_accounts = self.end_accounts = None
+        if self.series is not None:
+            self.series.reset(self.accounts)
+        if self.resolved is not None:
+            if self.resolved_key != (id(self.ledger), len(self.ledger)):
+                self.resolved = None
+        if self.resolved is not None:
+            self.accumulate()
+        else:
+            self.balance()
+        self.finish_snapshots()
+
+    def take_snapshots(self, date):
+        """takes the begin and end snapshots before the first entry after them"""
+        if not self.begin_accounts and date >= self.begin_date:
+            self.begin_accounts = self.snapshot()
+        if not self.end_accounts and date > self.end_date:
+            self.end_accounts = self.snapshot()
+
+    def finish_snapshots(self):
         if not self.begin_accounts:
-            self.begin_accounts = copy.deepcopy(self.accounts)
+            self.begin_accounts = self.snapshot()
         if not self.end_accounts:
-            self.end_accounts = copy.deepcopy(self.accounts)
-        self.diff_accounts = copy.deepcopy(self.accounts)
+            self.end_accounts = self.snapshot()
+        self.diff_accounts = self.snapshot()
         for name in self.diff_accounts:
             self.diff_accounts[name].wallet.sub(self.begin_accounts[name].wallet)
 
-    def report(self):
-        for name in sorted(self.accounts):
-            wallet = self.accounts[name].wallet
+    def check_open(self, item):
+        if isinstance(item, Transaction):
+            for posting in item.postings:
+                account = self.accounts[posting.name]
+                if item.date < account.open_date or item.date > account.close_date:
+                    err(f"Error: on {item.date} account {posting.name} is closed")
+
+    def balance(self):
+        self.unresolved = []  # balancing fills in all the elided postings
+        spill = tempfile.TemporaryFile() if self.runs else None
+        resolved = [] if not self.runs else None
+        for item in self.entries():
+            self.take_snapshots(item.date)
+            self.check_open(item)
+            if resolved is not None or self.series is not None:
+                self.journal = []
+            item.run(self)
+            if resolved is not None:
+                resolved.append((item.date, tuple(self.journal)))
+            if self.series is not None:
+                self.series.record(item.date, self.journal)
+            if spill:
+                pickle.dump(item, spill, pickle.HIGHEST_PROTOCOL)
+        self.journal = None
+        if spill:
+            for stream in self.runs:
+                stream.close()
+            self.runs, self.ledger = [spill], []
+        if resolved is not None:
+            fifos = dict((asset, list(fifo)) for asset, fifo in self.fifos.items())
+            self.resolved = (resolved, fifos)
+            self.resolved_key = (id(self.ledger), len(self.ledger))
+
+    def accumulate(self):
+        resolved, fifos = self.resolved
+        paths = dict()
+        for date, changes in resolved:
+            self.take_snapshots(date)
+            if self.series is not None:
+                self.series.record(date, changes)
+            for name, value, asset in changes:
+                if not name in paths:
+                    paths[name] = [self.accounts[sub] for sub in tree_traverse(name)]
+                for account in paths[name]:
+                    assets = account.wallet.assets
+                    assets[asset] = assets.get(asset, ZERO) + value
+        for asset, fifo in fifos.items():
+            self.fifos[asset] = list(fifo)
+
+    def run_sharded(self, processes=None, fiscal_month=1):
+        """
+        same as run() but the entries are split by fiscal year and the years
+        which do not depend on the balances before them (no balance checks,
+        pads, prices or capital gains) are added up in forked worker processes,
+        which return only the totals of each year. The totals are chained to
+        obtain the opening balances of the other years, which are balanced
+        here, in order, as are the years containing begin_date or end_date.
+        The elided postings of the years added up by the workers are filled
+        in by entries(), the first time the entries are needed again.
+        With a time series, after a run or where processes cannot be forked
+        this is the same as run().
+        """
+        if self.runs:
+            err("Sharded runs are not supported in streaming mode")
+        forkable = "fork" in multiprocessing.get_all_start_methods()
+        if self.series is not None or self.resolved is not None or not forkable:
+            return self.run()
+        ledger, shards, start = self.ledger, [], 0
+        key = lambda item: item.date
+        while start < len(ledger):
+            date = ledger[start].date
+            year = date.year + (date.month >= fiscal_month)
+            boundary = datetime.date(year, fiscal_month, 1)
+            stop = bisect.bisect_left(ledger, boundary, start, key=key)
+            shards.append((start, stop))
+            start = stop
+        # the snapshots are taken before these entries, their years are replayed here
+        first = bisect.bisect_left(ledger, self.begin_date, key=key)
+        last = bisect.bisect_right(ledger, self.end_date, key=key)
+        jobs = [
+            (start, stop)
+            for start, stop in shards
+            if not (start < first < stop or start < last < stop)
+        ]
+        context = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(
+            processes, context, share_ledger, (ledger, self.accounts)
+        ) as executor:
+            totals = dict(zip(jobs, executor.map(total_shard, *zip(*jobs))))
+        self.reset()
+        self.begin_accounts = self.end_accounts = None
+        self.unresolved = []
+        for start, stop in shards:
+            total = totals.get((start, stop))
+            if total is None:
+                for item in ledger[start:stop]:
+                    self.take_snapshots(item.date)
+                    self.check_open(item)
+                    item.run(self)
+            else:
+                self.take_snapshots(ledger[start].date)
+                for name, balance in total.items():
+                    for asset, value in balance.items():
+                        self.tree_add(name, value, asset)
+                self.unresolved.append(ledger[start:stop])
+        self.finish_snapshots()
+
+    def resolve(self):
+        """fills in the elided postings of the years added up by run_sharded"""
+        scratch = Pacioli()
+        scratch.accounts = self.accounts
+        scratch.tree_add = lambda name, value, asset: None  # balances are known
+        unresolved, self.unresolved = self.unresolved, []
+        for entries in unresolved:
+            for item in entries:
+                item.run(scratch)
+
+    def consolidate(self, entities, eliminate=(), processes=None):
+        """
+        loads and runs each entity ledger in a separate process and merges
+        the resulting balances into this (group) ledger
+        entities is a list of (filename, mapping) where mapping renames
+        entity accounts (or account prefixes) into group accounts
+        balances of the eliminate accounts (and their sub-accounts) are
+        removed from the group and their residual at end_date is stored in
+        self.eliminations
+        """
+        filenames = [filename for filename, _ in entities]
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            results = list(
+                executor.map(
+                    run_entity,
+                    filenames,
+                    [self.begin_date] * len(filenames),
+                    [self.end_date] * len(filenames),
+                )
+            )
+        self.eliminations = Wallet()
+        snapshots = dict()
+        for key in ("begin_accounts", "end_accounts", "diff_accounts", "accounts"):
+            self.reset()
+            for (_, mapping), result in zip(entities, results):
+                for name, balance in result[key].items():
+                    name = map_account(name, mapping or {})
+                    if any(sub in eliminate for sub in tree_traverse(name)):
+                        if key == "end_accounts":
+                            self.eliminations.add(balance.items())
+                        continue
+                    if not name.split(":")[0] in self.MODEL:
+                        err("invalid group account name: %s", name)
+                    self.open_account(name, BEGIN_TIME)
+                    for asset, value in balance.items():
+                        self.tree_add(name, value, asset)
+            snapshots[key] = copy.deepcopy(self.accounts)
+        for key in ("begin_accounts", "end_accounts", "diff_accounts"):
+            for name in self.accounts:
+                snapshots[key].setdefault(name, Account(name))
+            setattr(self, key, snapshots[key])
+        keys = set(x.rsplit(":", 1)[0] + ":" for x in self.accounts)
+        self.leaf_accounts = sorted(x for x in self.accounts if not x + ":" in keys)
+
+    def import_statement(self, entries, filename):
+        """
+        appends to filename (in the save format) the entries not already in
+        the ledger. Duplicates are found with a hash index on
+        (date, account, amount, payee) of the first posting of each entry.
+        Entries are streamed and not added to self.ledger.
+        returns (imported, skipped)
+        """
+        index = collections.Counter(
+            statement_key(transaction, posting)
+            for transaction in self.entries()
+            if isinstance(transaction, Transaction)
+            for posting in transaction.postings
+            if posting.amount is not None
+        )
+        n = max(len(name) for name in self.accounts)
+        imported = skipped = 0
+        with open_ledger(filename, "a") as stream:
+            for transaction in entries:
+                for posting in transaction.postings:
+                    if not posting.name in self.accounts:
+                        err("Unknown account: %s", posting.name)
+                key = statement_key(transaction, transaction.postings[0])
+                if index[key]:
+                    index[key] -= 1
+                    skipped += 1
+                else:
+                    if not imported:
+                        stream.write("\n")
+                    self.save_item(stream, transaction, n)
+                    imported += 1
+        return imported, skipped
+
+    def value_accounts(self, accounts, currency, date):
+        """
+        returns a copy of accounts (for example self.end_accounts) with the
+        wallets valued in currency at the prices of date. Assets without a
+        known price are left unconverted.
+        """
+        valued = dict()
+        for name, account in accounts.items():
+            wallet = Wallet()
+            for asset, value in account.wallet:
+                rate = self.prices.rate(asset, currency, date)
+                if rate is None:
+                    wallet.add(Amount(value, asset))
+                else:
+                    wallet.add(Amount(value * rate, currency))
+            valued[name] = Account(name, account.open_date, account.assets)
+            valued[name].wallet = wallet
+        return valued
+
+    def report(self, accounts=None):
+        accounts = self.accounts if accounts is None else accounts
+        for name in sorted(accounts):
+            wallet = accounts[name].wallet
             pad1 = " " * (40 - len(name))
             print(f"{name} {pad1}: {wallet}")
 
-    def save(self, filename, balance_with=None):
-        with open(filename, "w") as stream:
-            w = lambda msg, *args: stream.write(msg % args)
-            stream.write(";;; Accounts\n\n")
-            for name, acc in self.accounts.items():
-                assets = ' '.join(acc.assets or [])
-                w(f"{acc.open_date} open  {name} {assets}".strip() + '\n')
-                if acc.close_date < END_TIME:
-                    w(f"{acc.close_date} close {name} {assets}".strip() + '\n')
-            n = max(len(name) for name in self.accounts)
-            w("\n;; Transactions\n\n")
-            for item in self.ledger:
+    def save(self, filename, balance_with=None, index=False):
+        """if index, also writes the filename.idx used by load for date windows"""
+        self.check_complete(filename)
+        offsets, header = [], None
+        if index:
+            check_indexable(filename)
+        with open_ledger(filename, "w") as stream:
+            n = self.save_accounts(stream)
+            if index:
+                header = stream.tell()
+            previous = None
+            for position, item in enumerate(self.entries()):
                 if item.date > self.end_date:
                     break
-                elif isinstance(item, Check):
-                    if item.balance_with:
-                        w(f"{item.date} pad {item.name} {item.balance_with}\n")
-                    w(f"{item.date} balance {item.name} {item.amount}\n\n")
-                elif isinstance(item, Transaction):
-                    status = "!" if item.pending else "*"
-                    w(f"{item.date} {status} {item.info}\n")
-                    for posting in item.postings:
-                        if posting.book:
-                            w(f"  {posting.name} BOOK")
-                        elif posting.amount:
-                            m = "%.2f" % posting.amount.value
-                            padding = " " * (n - len(posting.name) + 15 - len(m))
-                            w(f"  {posting.name}{padding} {m} {posting.amount.asset}")
-                            if posting.at:
-                                w(f" @ {posting.at}")
-                        if posting.comment:
-                            w(f" ; {posting.comment}")
-                        w("\n")
-                    if item.tags:
-                        w(f"  tags {' '.join(item.tags)}\n")
-                    w("\n")
+                if index and item.date != previous:
+                    offsets.append((position, stream.tell()))
+                    previous = item.date
+                self.save_item(stream, item, n)
+        if index:
+            self.write_index(filename, header, offsets)
+
+    def check_complete(self, filename):
+        """a ledger loaded from an index window misses the entries before it"""
+        if self.opening:
+            err("Cannot save a ledger loaded from an index window: %s", filename)
+
+    def save_accounts(self, stream):
+        """writes the account declarations and returns the posting name width"""
+        w = stream.write
+        w(";;; Accounts\n\n")
+        for name, acc in self.accounts.items():
+            assets = " ".join(acc.assets or [])
+            w(f"{acc.open_date} open  {name} {assets}".strip() + "\n")
+            if acc.close_date < END_TIME:
+                w(f"{acc.close_date} close {name} {assets}".strip() + "\n")
+        if self.prices:
+            w("\n;; Prices\n\n")
+            for date, asset, value, currency in sorted(self.prices):
+                w(f"{date} price {asset} {value} {currency}\n")
+        w("\n;; Transactions\n\n")
+        return max(len(name) for name in self.accounts)
+
+    def save_item(self, stream, item, n):
+        w = stream.write
+        if isinstance(item, Check):
+            if item.balance_with:
+                w(f"{item.date} pad {item.name} {item.balance_with}\n")
+            w(f"{item.date} balance {item.name} {item.amount}\n\n")
+        elif isinstance(item, Transaction):
+            status = "!" if item.pending else "*"
+            w(f"{item.date} {status} {item.info}\n")
+            for posting in item.postings:
+                if posting.book:
+                    w(f"  {posting.name} BOOK")
+                elif posting.amount:
+                    m = "%.2f" % posting.amount.value
+                    padding = " " * (n - len(posting.name) + 15 - len(m))
+                    w(f"  {posting.name}{padding} {m} {posting.amount.asset}")
+                    if posting.at:
+                        w(f" @ {posting.at}")
+                else:
+                    w(f"  {posting.name}")
+                if posting.comment:
+                    w(f" ; {posting.comment}")
+                w("\n")
+            if item.tags:
+                w(f"  tags {' '.join(item.tags)}\n")
+            w("\n")
+
+    def index_item(self, item, dates, tags, accounts):
+        """adds a transaction in the [begin_date, end_date] window to the indexes"""
+        if (
+            isinstance(item, Transaction)
+            and self.begin_date <= item.date <= self.end_date
+        ):
+            dates.setdefault(item.date, []).append(item)
+            for tag in item.tags:
+                tags.setdefault(tag, []).append(item)
+            subs = set()
+            for posting in item.postings:
+                for sub in tree_traverse(posting.name):
+                    subs.add(sub)
+            for sub in subs:
+                accounts.setdefault(sub, []).append(item)
 
     def dates_tags_accounts(self):
         dates = dict()
         tags = dict()
         accounts = dict()
-        for transaction in self.ledger:
-            if (
-                isinstance(transaction, Transaction)
-                and self.begin_date <= transaction.date <= self.end_date
-            ):
-                dates[transaction.date] = dates.get(transaction.date, []) + [
-                    transaction
-                ]
-                for tag in transaction.tags:
-                    tags[tag] = tags.get(tag, []) + [transaction]
-                subs = set()
-                for posting in transaction.postings:
-                    for sub in tree_traverse(posting.name):
-                        subs.add(sub)
-                for sub in subs:
-                    accounts[sub] = accounts.get(sub, []) + [transaction]
+        for item in self.entries():
+            self.index_item(item, dates, tags, accounts)
         return dates, tags, accounts
 
-    def dump_html(self, path):
+    def render(self, sinks):
+        """
+        traverses the ledger once and fans out every item to the sinks
+        returns a dict with the time spent in each sink
+        """
+        timings = dict((sink.name, 0.0) for sink in sinks)
+        dates, tags, accounts = dict(), dict(), dict()
+        t0 = time.perf_counter()
+        for sink in sinks:
+            sink.begin(self)
+            t1 = time.perf_counter()
+            timings[sink.name] += t1 - t0
+            t0 = t1
+        indexed = any(sink.indexed for sink in sinks)
+        for item in self.entries():
+            if item.date > self.end_date:
+                break
+            if indexed:
+                self.index_item(item, dates, tags, accounts)
+            t0 = time.perf_counter()
+            for sink in sinks:
+                sink.entry(self, item)
+                t1 = time.perf_counter()
+                timings[sink.name] += t1 - t0
+                t0 = t1
+        for sink in sinks:
+            sink.end(self, (dates, tags, accounts))
+            t1 = time.perf_counter()
+            timings[sink.name] += t1 - t0
+            t0 = t1
+        return timings
+
+    def dump_html(self, path, index=None):
         HEAD = """<html>
         <head>
         <link href="http://twitter.github.com/bootstrap/assets/css/bootstrap.css" rel="stylesheet">
@@ -566,7 +1354,7 @@ class Pacioli:
         </head>
         <body>
         """
-        dates, tags, accounts = self.dates_tags_accounts()
+        dates, tags, accounts = index or self.dates_tags_accounts()
         e = lambda t: html.escape(t.replace("_", " "))
         n = (
             lambda v: v
@@ -575,8 +1363,16 @@ class Pacioli:
             if v < 0
             else ("%.2f" % v)
         )
-        if not os.path.exists(path):
-            os.mkdir(path)
+        if path.endswith(".zip"):
+            archive = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+            open_page = lambda name: io.TextIOWrapper(
+                archive.open(name, "w"), encoding="utf8"
+            )
+        else:
+            archive = None
+            if not os.path.exists(path):
+                os.mkdir(path)
+            open_page = lambda name: open(os.path.join(path, name), "w")
         ALE = (self.MODEL["Assets"], self.MODEL["Liabilities"], self.MODEL["Equity"])
         PL = (self.MODEL["Income"], self.MODEL["Expenses"])
 
@@ -594,7 +1390,7 @@ class Pacioli:
             )
 
         def dump_html_accounts(filename, header, accounts, s):
-            stream = open(filename, "w")
+            stream = open_page(filename)
             w = lambda s, *args: stream.write(s % args)
             w(HEAD)
             w('<div class="container">\n')
@@ -622,7 +1418,7 @@ class Pacioli:
             stream.close()
 
         def dump_html_index(filename, header):
-            stream = open(filename, "w")
+            stream = open_page(filename)
             w = lambda s, *args: stream.write(s % args)
             w(HEAD)
             w('<div class="container">\n')
@@ -656,7 +1452,7 @@ class Pacioli:
         def dump_html_accounts_diff(
             filename, header, accounts1, accounts2, accounts3, s
         ):
-            stream = open(filename, "w")
+            stream = open_page(filename)
             w = lambda s, *args: stream.write(s % args)
             w(HEAD)
             w('<div class="container">\n')
@@ -692,7 +1488,7 @@ class Pacioli:
             filename, header, transactions, name=None, wallet=None
         ):
             wallet = copy.copy(wallet)
-            stream = open(filename, "w")
+            stream = open_page(filename)
             w = lambda s, *args: stream.write(s % args)
             w(HEAD)
             w('<div class="container">\n')
@@ -744,21 +1540,21 @@ class Pacioli:
             w("</div></body></html>")
             stream.close()
 
-        dump_html_index(os.path.join(path, "index.html"), "Index")
+        dump_html_index("index.html", "Index")
         dump_html_accounts(
-            os.path.join(path, "begin_balance.html"),
+            "begin_balance.html",
             "Opening Balance (%s)" % self.begin_date,
             self.begin_accounts,
             ALE,
         )
         dump_html_accounts(
-            os.path.join(path, "end_balance.html"),
+            "end_balance.html",
             "Closing Balance (%s)" % self.end_date,
             self.end_accounts,
             ALE,
         )
         dump_html_accounts_diff(
-            os.path.join(path, "diff_balance.html"),
+            "diff_balance.html",
             "Difference Balance (%s-%s)" % (self.begin_date, self.end_date),
             self.begin_accounts,
             self.end_accounts,
@@ -766,31 +1562,33 @@ class Pacioli:
             ALE,
         )
         dump_html_accounts(
-            os.path.join(path, "profits_and_losses.html"),
+            "profits_and_losses.html",
             "Profits and Losses (%s-%s)" % (self.begin_date, self.end_date),
             self.diff_accounts,
             PL,
         )
         for date in dates:
             dump_html_transaction(
-                os.path.join(path, "date-%s.html" % date),
+                "date-%s.html" % date,
                 "Date: %s" % date,
                 dates[date],
             )
         for tag in tags:
             dump_html_transaction(
-                os.path.join(path, "tag-%s.html" % tag.lower()),
+                "tag-%s.html" % tag.lower(),
                 "Tag: %s" % tag,
                 tags[tag],
             )
         for name in accounts:
             dump_html_transaction(
-                os.path.join(path, "account-%s.html" % name.lower().replace(":", "-")),
+                "account-%s.html" % name.lower().replace(":", "-"),
                 "Account: %s" % name,
                 accounts[name],
                 name,
                 self.begin_accounts[name].wallet,
             )
+        if archive:
+            archive.close()
 
     @staticmethod
     def escape_latex(name):
@@ -811,8 +1609,8 @@ class Pacioli:
             else ("%.2f" % value)
         )
 
-    def dump_latex(self, filename):
-        dates, tags, accounts = self.dates_tags_accounts()
+    def dump_latex(self, filename, index=None):
+        dates, tags, accounts = index or self.dates_tags_accounts()
         e, n = self.escape_latex, self.number_latex
         ALE = (self.MODEL["Assets"], self.MODEL["Liabilities"], self.MODEL["Equity"])
         PL = (self.MODEL["Income"], self.MODEL["Expenses"])
@@ -908,6 +1706,403 @@ class Pacioli:
         for name in accounts:
             dump_latex_transaction("Account: %s" % name, accounts[name])
         w("\\end{document}")
+        stream.close()
+
+
+def run_entity(filename, begin_date, end_date):
+    """loads and runs one entity ledger, returns its own balances by snapshot"""
+    p = Pacioli()
+    p.load(filename)
+    p.begin_date, p.end_date = begin_date, end_date
+    p.run()
+    return dict(
+        (key, own_balances(getattr(p, key)))
+        for key in ("begin_accounts", "end_accounts", "diff_accounts", "accounts")
+    )
+
+
+def is_stateful(item):
+    """true if balancing the entry depends on the balances or lots before it"""
+    return not isinstance(item, Transaction) or any(
+        posting.at or posting.book for posting in item.postings
+    )
+
+
+SHARED = None  # the (ledger, accounts) of run_sharded in its worker processes
+
+
+def share_ledger(ledger, accounts):
+    global SHARED
+    SHARED = (ledger, accounts)
+
+
+def total_shard(start, stop):
+    """
+    balances the shared ledger[start:stop] from zero in a run_sharded worker
+    returns None if the entries depend on the balances or lots before them,
+    else the totals {account: {asset: value}}, excluding sub-accounts
+    """
+    ledger, accounts = SHARED
+    entries = ledger[start:stop]
+    if any(map(is_stateful, entries)):
+        return None
+    p = Pacioli()
+    p.accounts = accounts
+    p.reset()
+    for item in entries:
+        p.check_open(item)
+        item.run(p)
+    return own_balances(p.accounts)
+
+
+def load_consolidation(filename):
+    """
+    reads a consolidation file with lines like:
+      entity subsidiary.ledger
+      map Assets:Current:BestBank Assets:Bank   ; applies to the previous entity
+      eliminate Assets:Intercompany
+    returns (entities, eliminate) for Pacioli.consolidate
+    """
+    entities, eliminate = [], []
+    folder = os.path.dirname(filename)
+    with open(filename) as stream:
+        for lineno, line in enumerate(stream):
+            parts = line.split(";", 1)[0].split()
+            if not parts:
+                continue
+            elif parts[0] == "entity" and len(parts) == 2:
+                entities.append((os.path.join(folder, parts[1]), dict()))
+            elif parts[0] == "map" and len(parts) == 3 and entities:
+                entities[-1][1][parts[1]] = parts[2]
+            elif parts[0] == "eliminate" and len(parts) == 2:
+                eliminate.append(parts[1])
+            else:
+                err("%i: Invalid line: %s", lineno, line)
+    return entities, eliminate
+
+
+class Sink:
+    """base class of the outputs fed by Pacioli.render"""
+
+    name = None
+    indexed = False  # needs the transactions by date, tag and account
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def begin(self, p):
+        pass
+
+    def entry(self, p, item):
+        pass
+
+    def end(self, p, index):
+        pass
+
+
+class HtmlSink(Sink):
+    name = "html"
+    indexed = True
+
+    def end(self, p, index):
+        p.dump_html(self.filename, index)
+
+
+class LatexSink(Sink):
+    name = "latex"
+    indexed = True
+
+    def end(self, p, index):
+        p.dump_latex(self.filename, index)
+
+
+class LedgerSink(Sink):
+    name = "ledger"
+
+    def __init__(self, filename, index=False):
+        self.filename = filename
+        self.index = index
+
+    def begin(self, p):
+        p.check_complete(self.filename)
+        if self.index:
+            check_indexable(self.filename)
+        self.stream = open_ledger(self.filename, "w")
+        self.n = p.save_accounts(self.stream)
+        self.header = self.stream.tell() if self.index else None
+        self.offsets, self.position, self.previous = [], 0, None
+
+    def entry(self, p, item):
+        if self.index and item.date != self.previous:
+            self.offsets.append((self.position, self.stream.tell()))
+            self.previous = item.date
+        p.save_item(self.stream, item, self.n)
+        self.position += 1
+
+    def end(self, p, index):
+        self.stream.close()
+        if self.index:
+            p.write_index(self.filename, self.header, self.offsets)
+
+
+class JsonSink(Sink):
+    name = "json"
+
+    @staticmethod
+    def wallets(accounts):
+        return dict(
+            (name, dict((asset, str(value)) for asset, value in account.wallet))
+            for name, account in accounts.items()
+        )
+
+    def begin(self, p):
+        self.stream = open(self.filename, "w")
+        self.stream.write('{"transactions": [')
+        self.first = True
+
+    def entry(self, p, item):
+        if isinstance(item, Transaction) and item.date >= p.begin_date:
+            postings = [
+                dict(
+                    name=posting.name,
+                    value=str(posting.amount.value) if posting.amount else None,
+                    asset=posting.amount.asset if posting.amount else None,
+                    at=str(posting.at) if posting.at else None,
+                )
+                for posting in item.postings
+            ]
+            record = dict(
+                date=str(item.date),
+                info=item.info,
+                tags=sorted(item.tags),
+                pending=item.pending,
+                postings=postings,
+            )
+            separator = "\n" if self.first else ",\n"
+            self.stream.write(separator + json.dumps(record))
+            self.first = False
+
+    def end(self, p, index):
+        w = lambda s, *args: self.stream.write(s % args)
+        w("],\n")
+        w('"begin_date": "%s", "end_date": "%s",\n', p.begin_date, p.end_date)
+        w('"begin_balance": %s,\n', json.dumps(self.wallets(p.begin_accounts)))
+        w('"end_balance": %s,\n', json.dumps(self.wallets(p.end_accounts)))
+        w('"diff_balance": %s}\n', json.dumps(self.wallets(p.diff_accounts)))
+        self.stream.close()
+
+
+class CubeSink(Sink):
+    """
+    sums the postings by (tag, account, period, asset) and stores them as a Cube
+    the tag "" is the total over all transactions and every account includes
+    its sub-accounts; values are stored as integers in units of 10**-scale,
+    by default scale is the largest number of decimals of the values
+    """
+
+    name = "cube"
+
+    def __init__(self, filename, period="%Y-%m", scale=None):
+        self.filename = filename
+        self.period = period
+        self.scale = scale
+
+    def begin(self, p):
+        self.cells = collections.defaultdict(lambda: ZERO)
+        self.periods = dict()
+
+    def entry(self, p, item):
+        if isinstance(item, Transaction) and item.date >= p.begin_date:
+            if not item.date in self.periods:
+                self.periods[item.date] = item.date.strftime(self.period)
+            period = self.periods[item.date]
+            tags = ("",) + tuple(item.tags)
+            for posting in item.postings:
+                if posting.amount is None:
+                    continue
+                value, asset = posting.amount.value, posting.amount.asset
+                for sub in tree_traverse(posting.name):
+                    for tag in tags:
+                        self.cells[tag, sub, period, asset] += value
+
+    def end(self, p, index):
+        Cube.write(self.filename, self.cells, p.begin_date, p.end_date, self.scale)
+        del self.cells
+
+
+class Cube:
+    """
+    read only, memory mapped view of the aggregates stored by CubeSink
+    records are sorted by (tag, account, period, asset) so that slices
+    with a given tag (and account) are found by bisection
+    """
+
+    MAGIC = b"PACIOLI-CUBE-1\n"
+    HEADER = struct.Struct("<Q")
+    RECORD = struct.Struct("<IIIIq")
+    LIMIT = 2**63
+    DIMENSIONS = ("tag", "account", "period", "asset")
+
+    def __init__(self, filename):
+        self.stream = open(filename, "rb")
+        self.data = mmap.mmap(self.stream.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[: len(self.MAGIC)] != self.MAGIC:
+            err("%s: not a cube file", filename)
+        offset = len(self.MAGIC)
+        (size,) = self.HEADER.unpack_from(self.data, offset)
+        offset += self.HEADER.size
+        header = json.loads(self.data[offset : offset + size])
+        self.offset = offset + size
+        self.begin_date = parse_date(header["begin_date"])
+        self.end_date = parse_date(header["end_date"])
+        self.count = header["count"]
+        self.scale = header.get("scale", 6)
+        self.names = [header[key + "s"] for key in self.DIMENSIONS]
+        self.ids = [dict((v, k) for k, v in enumerate(names)) for names in self.names]
+        self.tags, self.accounts, self.periods, self.assets = self.names
+
+    @classmethod
+    def write(cls, filename, cells, begin_date, end_date, scale=None):
+        """
+        cells is a dict {(tag, account, period, asset): value}
+        values are stored as integers in units of 10**-scale (by default the
+        largest number of decimals of the values), a value with more decimals
+        or too large for 64 bits is an error. The file is written under a
+        temporary name and renamed, so readers never see a partial cube.
+        """
+        if scale is None:
+            exponents = (value.as_tuple().exponent for value in cells.values())
+            scale = max(0, -min(exponents, default=0))
+        values = dict()
+        for key, value in cells.items():
+            scaled = value.scaleb(scale)
+            if scaled != scaled.to_integral_value():
+                err("cube value %s has more than %i decimals", value, scale)
+            elif not -cls.LIMIT <= scaled < cls.LIMIT:
+                err("cube value %s is too large for scale %i", value, scale)
+            values[key] = int(scaled)
+        names = [sorted(set(key[k] for key in cells)) for k in range(4)]
+        ids = [dict((v, k) for k, v in enumerate(items)) for items in names]
+        header = dict((key + "s", names[k]) for k, key in enumerate(cls.DIMENSIONS))
+        header.update(begin_date=str(begin_date), end_date=str(end_date))
+        header.update(count=len(cells), scale=scale)
+        header = json.dumps(header).encode("utf8")
+        records = sorted(
+            (tuple(ids[k][key[k]] for k in range(4)), value)
+            for key, value in values.items()
+        )
+        with open(filename + ".tmp", "wb") as stream:
+            stream.write(cls.MAGIC)
+            stream.write(cls.HEADER.pack(len(header)))
+            stream.write(header)
+            for key, value in records:
+                stream.write(cls.RECORD.pack(*key, value))
+        os.replace(filename + ".tmp", filename)
+
+    def close(self):
+        self.data.close()
+        self.stream.close()
+
+    def record(self, i):
+        return self.RECORD.unpack_from(self.data, self.offset + i * self.RECORD.size)
+
+    def bisect(self, prefix):
+        """index of the first record with key[: len(prefix)] >= prefix"""
+        lo, hi, n = 0, self.count, len(prefix)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(mid)[:n] < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def slice(self, tag="", account=None, period=None, asset=None):
+        """
+        yields (tag, account, period, asset, value) for the matching cells
+        None matches anything, the default tag "" is the total of all transactions
+        """
+        query = []
+        for k, value in enumerate((tag, account, period, asset)):
+            if value is None:
+                query.append(None)
+            elif value in self.ids[k]:
+                query.append(self.ids[k][value])
+            else:
+                return
+        prefix = []
+        for value in query:
+            if value is None:
+                break
+            prefix.append(value)
+        prefix = tuple(prefix)
+        start = self.bisect(prefix)
+        stop = self.bisect(prefix[:-1] + (prefix[-1] + 1,)) if prefix else self.count
+        for i in range(start, stop):
+            record = self.record(i)
+            if all(q is None or q == r for q, r in zip(query, record)):
+                key = tuple(self.names[k][record[k]] for k in range(4))
+                yield key + (R(record[4]).scaleb(-self.scale),)
+
+    def pivot(self, rows, columns, **query):
+        """
+        returns {row: {column: value}} where rows and columns are dimensions
+        example: cube.pivot("account", "period", tag="client-0001", asset="USD")
+        """
+        i, j = self.DIMENSIONS.index(rows), self.DIMENSIONS.index(columns)
+        table = dict()
+        for record in self.slice(**query):
+            row = table.setdefault(record[i], dict())
+            row[record[j]] = row.get(record[j], ZERO) + record[4]
+        return table
+
+
+class SeriesSink(Sink):
+    """writes the balance time series recorded by run (requires p.series)"""
+
+    name = "series"
+
+    def __init__(self, filename, period=None):
+        self.filename = filename
+        self.period = period
+
+    def end(self, p, index):
+        if p.series is None:
+            err("No time series recorded, set p.series = TimeSeries() before run()")
+        p.series.dump(self.filename, self.period)
+
+
+SINKS = dict(
+    (sink.name, sink)
+    for sink in (HtmlSink, LatexSink, LedgerSink, JsonSink, CubeSink, SeriesSink)
+)
+
+
+def serve(path, port):
+    """serves the html reports from a folder or from a .zip archive"""
+    archive = zipfile.ZipFile(path) if path.endswith(".zip") else None
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            name = urllib.parse.urlparse(self.path).path
+            name = os.path.basename(urllib.parse.unquote(name)) or "index.html"
+            try:
+                if archive:
+                    data = archive.read(name)
+                else:
+                    with open(os.path.join(path, name), "rb") as stream:
+                        data = stream.read()
+            except (KeyError, OSError):
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    print(f"serving {path} on http://localhost:{port}/")
+    http.server.HTTPServer(("", port), Handler).serve_forever()
 
 
 def main():
@@ -926,19 +2121,200 @@ def main():
         default="{input.ledger}.output",
         help="folder where to store output",
     )
+    parser.add_argument(
+        "-r",
+        "--reports",
+        default="html,latex,ledger",
+        help="comma separated outputs (html, latex, ledger, json, cube, series)",
+    )
+    parser.add_argument(
+        "-B",
+        "--benchmark",
+        action="store_true",
+        default=False,
+        help="report time per transaction and memory per posting",
+    )
+    parser.add_argument(
+        "-c",
+        "--consolidate",
+        default=None,
+        help="consolidation file listing the entity ledgers (replaces -i)",
+    )
+    parser.add_argument(
+        "-s",
+        "--statement",
+        default=None,
+        help="OFX or CSV bank statement to import (appended to the input ledger)",
+    )
+    parser.add_argument(
+        "-a",
+        "--account",
+        default=None,
+        help="the account of the imported statement",
+    )
+    parser.add_argument(
+        "--balance_with",
+        default="Expenses:Unknown",
+        help="the account balancing the imported statement records (must be opened)",
+    )
+    parser.add_argument(
+        "--series_period",
+        default=None,
+        help="downsample -r series to this strftime period (e.g. %%Y-%%m)",
+    )
+    parser.add_argument(
+        "-x",
+        "--index",
+        action="store_true",
+        default=False,
+        help="index the output ledger by date for faster -b/-e loads",
+    )
+    parser.add_argument(
+        "-v",
+        "--value",
+        default=None,
+        help="also report the end balance at market value in this currency",
+    )
+    parser.add_argument(
+        "--run_size",
+        type=int,
+        default=None,
+        help="streaming mode: keep the ledger on disk in sorted runs of this size",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="add up the independent years of the ledger in this number of processes",
+    )
+    parser.add_argument(
+        "-z",
+        "--zip",
+        action="store_true",
+        default=False,
+        help="write the html pages in a single <input.ledger>.html.zip archive",
+    )
+    parser.add_argument(
+        "-w",
+        "--web",
+        type=int,
+        default=None,
+        help="serve the html reports on this port",
+    )
     args = parser.parse_args()
+    if args.statement:
+        if not args.account:
+            parser.error("-s/--statement requires -a/--account")
+        p = Pacioli()
+        p.load(args.input)
+        for name in (args.account, args.balance_with):
+            if not name in p.accounts:
+                parser.error(f"account {name} is not opened in {args.input}")
+        if args.statement.lower().endswith((".ofx", ".qfx")):
+            with open_ledger(args.statement) as stream:
+                entries = read_ofx(stream, args.account, args.balance_with)
+                imported, skipped = p.import_statement(entries, args.input)
+        else:
+            with open_ledger(args.statement, newline="") as stream:
+                entries = read_csv(stream, args.account, args.balance_with)
+                imported, skipped = p.import_statement(entries, args.input)
+        print(f"imported {imported} entries, skipped {skipped} duplicates")
+        return
+    if args.consolidate:
+        args.input = args.consolidate
     folder = args.folder.replace("{input.ledger}", args.input)
 
-    p = Pacioli()
-    p.load(args.input)
+    p = Pacioli(args.run_size)
     p.begin_date = parse_date(args.begin_date)
     p.end_date = parse_date(args.end_date)
-    p.run()
+    if args.consolidate:
+        t0 = time.time()
+        p.consolidate(*load_consolidation(args.consolidate))
+        if args.benchmark:
+            print("benchmark: consolidation %.2e sec" % (time.time() - t0))
+        if p.eliminations.value():
+            print(f"eliminations residual: {p.eliminations}")
+    else:
+        t0 = time.time()
+        if "ledger" in args.reports.split(","):
+            # the output ledger needs all the entries, not only an index window
+            p.load(args.input)
+        else:
+            p.load(args.input, p.begin_date, p.end_date)
+        if "series" in args.reports.split(","):
+            p.series = TimeSeries()
+        if args.jobs:
+            p.run_sharded(args.jobs)
+        else:
+            p.run()
+        seconds = time.time() - t0
+    if args.benchmark and not args.consolidate:
+        transactions = sum(1 for x in p.entries() if isinstance(x, Transaction))
+        print("benchmark: %.2e sec/transaction" % (seconds / max(1, transactions)))
+        for interned in (False, True):
+            memory, postings = measure_memory(
+                args.input, p.begin_date, p.end_date, interned, args.run_size
+            )
+            print(
+                "benchmark: %i bytes/posting (%s)"
+                % (memory / max(1, postings), "interned" if interned else "baseline")
+            )
     p.report()
+    if args.value:
+        if args.benchmark:
+            # values all the accounts at up to 120 of the dates with prices
+            dates = sorted(set(date for date, _, _, _ in p.prices))
+            dates = dates[:: max(1, len(dates) // 120)]
+            t0 = time.time()
+            for date in dates:
+                p.value_accounts(p.end_accounts, args.value, date)
+            count = len(dates) * len(p.end_accounts)
+            seconds = (time.time() - t0) / max(1, count)
+            print(
+                "benchmark: valuation %.2e sec/account (%i accounts at %i dates)"
+                % (seconds, len(p.end_accounts), len(dates))
+            )
+        valued = p.value_accounts(p.end_accounts, args.value, p.end_date)
+        print(f"Market value in {args.value} on {p.end_date}")
+        p.report(valued)
     if folder:
-        p.dump_html(folder)
-        p.dump_latex(os.path.join(folder, args.input + ".latex"))
-        p.save(os.path.join(folder, args.input + ".end"))
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+        html_path, basename = folder, os.path.basename(args.input)
+        if args.zip:
+            html_path = os.path.join(folder, basename + ".html.zip")
+        filenames = dict(
+            html=html_path,
+            latex=os.path.join(folder, basename + ".latex"),
+            ledger=os.path.join(folder, basename + ".end"),
+            json=os.path.join(folder, basename + ".json"),
+            cube=os.path.join(folder, basename + ".cube"),
+            series=os.path.join(folder, basename + ".series.json"),
+        )
+        sinks = []
+        for name in args.reports.split(","):
+            if not name in SINKS:
+                err("Unknown report format: %s", name)
+            elif name == "ledger":
+                sinks.append(LedgerSink(filenames[name], index=args.index))
+            elif name == "series":
+                sinks.append(SeriesSink(filenames[name], args.series_period))
+            else:
+                sinks.append(SINKS[name](filenames[name]))
+        timings = p.render(sinks)
+        if args.benchmark:
+            for name, seconds in timings.items():
+                print("benchmark: %s %.2e sec" % (name, seconds))
+            if "html" in timings:
+                if args.zip:
+                    size = os.path.getsize(html_path)
+                else:
+                    names = [os.path.join(folder, x) for x in os.listdir(folder)]
+                    size = sum(os.path.getsize(x) for x in names if x.endswith(".html"))
+                print("benchmark: html %i bytes" % size)
+        if args.web:
+            serve(html_path, args.web)
 
 
 if __name__ == "__main__":
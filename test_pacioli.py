@@ -0,0 +1,260 @@
+import datetime
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from pacioli import Amount, Cube, LedgerSink, Pacioli, Posting, R, Transaction
+from pacioli import read_ofx
+
+ACCOUNTS = """
+2000-01-01 open Assets:Bank
+2000-01-01 open Assets:Cash
+2000-01-01 open Assets:Broker
+2000-01-01 open Assets:Broker:AAPL
+2000-01-01 open Equity:Opening-Balances
+2000-01-01 open Expenses:Food
+2000-01-01 open Income:Salary
+2000-01-01 open Income:Capital-Gains
+"""
+
+
+def make_ledger(years):
+    """a ledger with independent years and stateful years (pads, checks and lots)"""
+    lines = [ACCOUNTS]
+    for year in years:
+        for month in range(1, 13):
+            date = datetime.date(year, month, 15)
+            lines.append(
+                f"{date} * salary\n  Assets:Bank  1000.00 USD\n  Income:Salary\n"
+            )
+            lines.append(
+                f"{date} * food\n  Expenses:Food  {month}.25 USD\n  Assets:Cash\n"
+            )
+        if year == years[1]:
+            lines.append(f"{year}-03-01 pad Assets:Cash Equity:Opening-Balances\n")
+            lines.append(f"{year}-03-02 balance Assets:Cash 100 USD\n")
+        if year == years[2]:
+            lines.append(
+                f"{year}-05-01 * buy\n  Assets:Broker:AAPL  10 AAPL @ 100 USD\n"
+                "  Assets:Broker\n"
+            )
+        if year == years[3]:
+            lines.append(
+                f"{year}-06-01 * sell\n  Assets:Broker:AAPL  -10 AAPL @ 120 USD\n"
+                "  Assets:Broker  1200 USD\n  Income:Capital-Gains  BOOK AAPL\n"
+            )
+    return "\n".join(lines)
+
+
+def balances(p):
+    """the non zero balances of the begin, end, diff and final accounts"""
+    wallet = lambda account: dict((a, v) for a, v in account.wallet if v)
+    return [
+        dict((name, wallet(acc)) for name, acc in getattr(p, key).items())
+        for key in ("begin_accounts", "end_accounts", "diff_accounts", "accounts")
+    ]
+
+
+def postings(p):
+    return [
+        [(x.name, x.amount.value, x.amount.asset) for x in item.postings]
+        for item in p.entries()
+        if isinstance(item, Transaction)
+    ]
+
+
+class TestRunSharded(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "test.ledger")
+        with open(self.filename, "w") as stream:
+            stream.write(make_ledger(list(range(2001, 2009))))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def run_ledger(self, begin_date, end_date, sharded):
+        p = Pacioli()
+        p.load(self.filename)
+        p.begin_date, p.end_date = begin_date, end_date
+        if sharded:
+            p.run_sharded(2)
+        else:
+            p.run()
+        return balances(p), postings(p)
+
+    def test_same_as_run(self):
+        windows = [
+            (datetime.date(2000, 1, 1), datetime.date(2999, 12, 31)),
+            (datetime.date(2002, 1, 1), datetime.date(2002, 12, 31)),
+            (datetime.date(2003, 7, 1), datetime.date(2006, 2, 1)),
+            (datetime.date(2007, 4, 10), datetime.date(2007, 4, 10)),
+        ]
+        for begin_date, end_date in windows:
+            expected = self.run_ledger(begin_date, end_date, False)
+            result = self.run_ledger(begin_date, end_date, True)
+            self.assertEqual(result[0], expected[0], (begin_date, end_date))
+            self.assertEqual(result[1], expected[1], (begin_date, end_date))
+
+
+class TestResolved(unittest.TestCase):
+    def test_ledger_changed(self):
+        p = Pacioli()
+        p.load(io.StringIO(make_ledger([2001, 2002, 2003, 2004])))
+        p.run()
+        cash = p.accounts["Assets:Bank"].wallet["USD"]
+        bank = Posting("Assets:Bank", Amount("5", "USD"))
+        postings = [bank, Posting("Income:Salary")]
+        p.ledger.append(Transaction("2005-01-01", "bonus", postings=postings))
+        p.run()
+        self.assertEqual(p.accounts["Assets:Bank"].wallet["USD"], cash + 5)
+
+
+class TestCompressed(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "test.ledger")
+        with open(self.filename, "w") as stream:
+            stream.write(make_ledger(list(range(2001, 2005))))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def load(self, filename):
+        p = Pacioli()
+        p.load(filename)
+        p.run()
+        return p
+
+    def test_round_trip(self):
+        p = self.load(self.filename)
+        for extension in (".gz", ".xz", ".bz2"):
+            saved = os.path.join(self.folder, "saved.ledger" + extension)
+            rendered = os.path.join(self.folder, "rendered.ledger" + extension)
+            p.save(saved)
+            p.render([LedgerSink(rendered)])
+            for filename in (saved, rendered):
+                q = self.load(filename)
+                self.assertEqual(balances(q), balances(p), filename)
+                self.assertEqual(postings(q), postings(p), filename)
+
+    def test_no_index(self):
+        p = self.load(self.filename)
+        with self.assertRaises(RuntimeError):
+            p.save(os.path.join(self.folder, "saved.ledger.xz"), index=True)
+
+
+class TestStatements(unittest.TestCase):
+    OFX = (
+        "<OFX><CURDEF>USD<BANKTRANLIST>\n"
+        "<STMTTRN><DTPOSTED>20080501<TRNAMT>-3.50<NAME>Tea &amp; Co</STMTTRN>\n"
+        "</BANKTRANLIST></OFX>\n"
+    )
+
+    def test_ofx_entities(self):
+        (transaction,) = read_ofx(io.StringIO(self.OFX), "Assets:Cash", "Expenses:Food")
+        self.assertEqual(transaction.info, "Tea & Co")
+        self.assertEqual(transaction.postings[0].amount.value, -3.5)
+
+    def test_ofx_missing_amount(self):
+        stream = io.StringIO(self.OFX.replace("<TRNAMT>-3.50", ""))
+        with self.assertRaises(RuntimeError):
+            list(read_ofx(stream, "Assets:Cash", "Expenses:Food"))
+
+
+class TestCube(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "test.cube")
+        self.date = datetime.date(2001, 1, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_scale_from_data(self):
+        cells = {("", "Assets", "2001-01", "BTC"): R("0.12345678")}
+        Cube.write(self.filename, cells, self.date, self.date)
+        cube = Cube(self.filename)
+        (record,) = cube.slice()
+        self.assertEqual(record, ("", "Assets", "2001-01", "BTC", R("0.12345678")))
+        cube.close()
+
+    def test_refused_value_leaves_no_file(self):
+        cells = {("", "Assets", "2001-01", "USD"): R("1e13")}
+        with self.assertRaises(RuntimeError):
+            Cube.write(self.filename, cells, self.date, self.date, scale=6)
+        self.assertEqual(os.listdir(self.folder), [])
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "test.ledger")
+        with open(self.filename, "w") as stream:
+            stream.write(make_ledger(list(range(2001, 2006))))
+        self.indexed = os.path.join(self.folder, "indexed.ledger")
+        self.every, Pacioli.CHECKPOINT_EVERY = Pacioli.CHECKPOINT_EVERY, 7
+        p = Pacioli()
+        p.load(self.filename)
+        p.run()
+        p.save(self.indexed, index=True)
+
+    def tearDown(self):
+        Pacioli.CHECKPOINT_EVERY = self.every
+        shutil.rmtree(self.folder)
+
+    def run_ledger(self, begin_date, end_date, window):
+        p = Pacioli()
+        p.begin_date, p.end_date = begin_date, end_date
+        if window:
+            p.load(self.indexed, begin_date, end_date)
+        else:
+            p.load(self.indexed)
+        p.run()
+        return p
+
+    def test_window_same_as_full(self):
+        windows = [
+            (datetime.date(2002, 3, 1), datetime.date(2002, 3, 31)),
+            (datetime.date(2003, 7, 1), datetime.date(2004, 6, 30)),
+            (datetime.date(2005, 12, 1), datetime.date(2999, 12, 31)),
+        ]
+        for begin_date, end_date in windows:
+            full = self.run_ledger(begin_date, end_date, False)
+            window = self.run_ledger(begin_date, end_date, True)
+            self.assertIsNotNone(window.opening)
+            self.assertLess(len(window.ledger), len(full.ledger))
+            self.assertEqual(balances(window)[:2], balances(full)[:2])
+
+    def test_window_is_not_saved(self):
+        date = datetime.date(2003, 3, 1)
+        p = self.run_ledger(date, date, True)
+        with self.assertRaises(RuntimeError):
+            p.save(os.path.join(self.folder, "window.ledger"))
+        with self.assertRaises(RuntimeError):
+            p.render([LedgerSink(os.path.join(self.folder, "window.ledger"))])
+
+    def test_empty_ledger(self):
+        empty = os.path.join(self.folder, "empty.ledger")
+        p = Pacioli()
+        p.open_account("Assets:Cash", datetime.date(2001, 1, 1))
+        p.save(empty, index=True)
+        date = datetime.date(2001, 1, 1)
+        q = Pacioli()
+        q.load(empty, date, date)
+        self.assertIsNone(q.opening)
+        self.assertIn("Assets:Cash", q.accounts)
+
+    def test_stale_index(self):
+        with open(self.indexed) as stream:
+            data = stream.read()
+        position = data.index("1000.00 USD")
+        with open(self.indexed, "w") as stream:
+            stream.write(data[:position] + "2" + data[position + 1 :])
+        self.assertIsNone(Pacioli().load_index(self.indexed))
+
+
+if __name__ == "__main__":
+    unittest.main()